@@ -1,10 +1,8 @@
 import os
-import sqlite3
-import json
-import pandas as pd
 import duckdb
 import sys
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 
 # Paths
 ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -16,91 +14,301 @@ DEPARTMENTS_PATH = os.path.join(INPUT_DIR, "departments.json")
 OUT_DUCKDB = os.path.join(ROOT, "ku.duckdb")
 OUT_CSV = os.path.join(ROOT, "output.csv")
 
+# share of physical memory DuckDB may use before spilling to disk
+MEMORY_FRACTION = 0.6
+
+_SIZE_UNITS = {"BYTES": 1, "KB": 10**3, "MB": 10**6, "GB": 10**9, "TB": 10**12, "PB": 10**15,
+               "KIB": 2**10, "MIB": 2**20, "GIB": 2**30, "TIB": 2**40, "PIB": 2**50}
+
+def _parse_size(text):
+    # DuckDB reports sizes like "3.3 GiB" or "500.0 MB"
+    number, _, unit = text.strip().partition(" ")
+    return int(float(number) * _SIZE_UNITS[unit.upper()])
+
+def _memory_limit(con_duck):
+    try:
+        total = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, ValueError, OSError):
+        return None  # no sysconf (e.g. Windows): keep DuckDB's default limit
+    # sysconf sees host RAM, not container/cgroup limits; DuckDB's own default
+    # does, so only ever lower it
+    try:
+        default = _parse_size(con_duck.execute("SELECT current_setting('memory_limit')").fetchone()[0])
+    except (KeyError, ValueError):
+        return None
+    limit = int(total * MEMORY_FRACTION)
+    if limit >= default:
+        return None
+    return f"{limit // 2**20}MiB"
+
+def configure(con_duck):
+    # let DuckDB aggregate/insert in parallel without keeping row order; every query
+    # whose order matters has an explicit ORDER BY. threads stays at DuckDB's default,
+    # which already respects CPU affinity and cgroup quotas
+    con_duck.execute("SET preserve_insertion_order = false")
+    memory_limit = _memory_limit(con_duck)
+    if memory_limit:
+        con_duck.execute(f"SET memory_limit = '{memory_limit}'")
+
 # helper loaders
+def _quote_ident(name):
+    return '"' + name.replace('"', '""') + '"'
+
+def _quote_literal(value):
+    return "'" + value.replace("'", "''") + "'"
+
 def load_sqlite_tables_to_duckdb(con_duck, sqlite_path):
-    sqlite_conn = sqlite3.connect(sqlite_path)
-    tables = [r[0] for r in sqlite_conn.execute("SELECT name FROM sqlite_master WHERE type='table'").fetchall()]
-    for t in tables:
-        df = pd.read_sql_query(f"SELECT * FROM {t}", sqlite_conn)
-        df.columns = [c.upper() for c in df.columns]
-        con_duck.register("tmp_df", df)
-        con_duck.execute(f"CREATE OR REPLACE TABLE {t.lower()} AS SELECT * FROM tmp_df")
-        con_duck.unregister("tmp_df")
-        
-       
-        # print(f"  ✓ Loaded table '{t}': {len(df)} rows")
-    sqlite_conn.close()
+    # load the sqlite extension explicitly rather than relying on ATTACH autoloading
+    # it, which is disabled in some DuckDB builds (INSTALL is a no-op once installed)
+    con_duck.execute("INSTALL sqlite; LOAD sqlite")
+    # ATTACH does not accept bind parameters, so the path is quoted as a literal
+    con_duck.execute(f"ATTACH {_quote_literal(sqlite_path)} AS sqlite_src (TYPE sqlite, READ_ONLY)")
+    try:
+        # one catalog query for every table's columns instead of a probe per table;
+        # typed columns are the non-VARCHAR/BLOB ones, the only ones that can mismatch
+        tables = con_duck.execute("""
+            SELECT table_name, list(column_name ORDER BY ordinal_position),
+                   list(column_name) FILTER (WHERE data_type NOT IN ('VARCHAR', 'BLOB'))
+            FROM information_schema.columns
+            WHERE table_catalog = 'sqlite_src'
+            GROUP BY table_name
+        """).fetchall()
+        statements, varchar_statements = [], []
+        for t, cols, typed_cols in tables:
+            select_list = ", ".join(f"{_quote_ident(c)} AS {_quote_ident(c.upper())}" for c in cols)
+            mismatch = _has_type_mismatch(con_duck, t, typed_cols or [])
+            source = "sqlite_text" if mismatch else "sqlite_src"
+            (varchar_statements if mismatch else statements).append(
+                f"CREATE OR REPLACE TABLE {t.lower()} AS SELECT {select_list} FROM {source}.{_quote_ident(t)}"
+            )
+        # one script for all tables instead of an execute() round-trip per table
+        if statements:
+            con_duck.execute(";\n".join(statements))
+        # tables holding values that don't match their declared types are read as
+        # text, as pandas read them, instead of failing the load. The scanner fixes
+        # column types when it first sees a table in a transaction, so they are read
+        # through a second attach made with sqlite_all_varchar on
+        if varchar_statements:
+            con_duck.execute("SET sqlite_all_varchar = true")
+            try:
+                con_duck.execute(
+                    f"ATTACH {_quote_literal(sqlite_path)} AS sqlite_text (TYPE sqlite, READ_ONLY)"
+                )
+                try:
+                    con_duck.execute(";\n".join(varchar_statements))
+                finally:
+                    con_duck.execute("DETACH sqlite_text")
+            finally:
+                con_duck.execute("RESET sqlite_all_varchar")
+    finally:
+        con_duck.execute("DETACH sqlite_src")
+
+def _has_type_mismatch(con_duck, table, typed_cols):
+    # the sqlite scanner raises on a value that doesn't match its column's declared
+    # type (e.g. text in an INTEGER column). Reading the typed columns on a separate
+    # cursor finds those tables without aborting the caller's transaction
+    if not typed_cols:
+        return False
+    counts = ", ".join(f"count({_quote_ident(c)})" for c in typed_cols)
+    probe = con_duck.cursor()
+    try:
+        probe.execute(f"SELECT {counts} FROM sqlite_src.{_quote_ident(table)}")
+    except duckdb.TypeMismatchException:
+        return True
+    finally:
+        probe.close()
+    return False
+
+def _clean_select_list(con_duck, relation, casts=None, params=None):
+    # uppercase column names and trim text columns inside the CTAS itself, so the
+    # data is cleaned in the same pass that loads it
+    casts = casts or {}
+    select_list = []
+    columns = con_duck.execute(f"DESCRIBE SELECT * FROM {relation}", params).fetchall()
+    for name, col_type, *_ in columns:
+        expr = _quote_ident(name)
+        if col_type == "VARCHAR":
+            expr = f"TRIM({expr})"
+        if name.upper() in casts:
+            expr = casts[name.upper()].format(col=expr)
+        select_list.append(f"{expr} AS {_quote_ident(name.upper())}")
+    return ", ".join(select_list)
+
+# unparseable credit hours (including NaN and out-of-range values) count as 0,
+# fractional ones are truncated; the column is typed BIGINT (pandas' int64) here
+# once so the transforms can aggregate it without casting
+# pandas' default NA tokens: the original pd.read_csv loader read these as missing
+NA_TOKENS = ("", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan",
+             "1.#IND", "1.#QNAN", "<NA>", "N/A", "NA", "NULL", "NaN", "None",
+             "n/a", "nan", "null")
+
+ENROLLMENT_CASTS = {
+    "CREDIT_HOURS": "COALESCE(TRY_CAST(TRUNC(TRY_CAST({col} AS DOUBLE)) AS BIGINT), 0)",
+}
 
 def load_enrollments_to_duckdb(con_duck, enrollments_path):
-    df = pd.read_csv(enrollments_path, sep="|", dtype=str)
-    df.columns = [c.upper() for c in df.columns]
-    for c in df.select_dtypes(include=["object", "string"]).columns:
-        df[c] = df[c].str.strip()
-    if "CREDIT_HOURS" in df.columns:
-        df["CREDIT_HOURS"] = pd.to_numeric(df["CREDIT_HOURS"], errors="coerce").fillna(0).astype(int)
-    con_duck.register("tmp_enr", df)
-    con_duck.execute("CREATE OR REPLACE TABLE enrollments AS SELECT * FROM tmp_enr")
-    con_duck.unregister("tmp_enr")
-    
-    # print(f"  ✓ Loaded enrollments: {len(df)} records")
+    # DuckDB's (multi-threaded) CSV reader feeds the CTAS directly; every field is
+    # read as text so the cleaning projection decides how values are coerced;
+    # short rows are padded with NULL and the NA tokens read as NULL, as pandas did
+    nullstr = ", ".join(_quote_literal(token) for token in NA_TOKENS)
+    source = ("read_csv(?, delim='|', header=true, all_varchar=true, "
+              f"null_padding=true, nullstr=[{nullstr}])")
+    select_list = _clean_select_list(con_duck, source, ENROLLMENT_CASTS, [enrollments_path])
+    # store rows clustered on the join keys: tighter zone maps for EMPLID/STRM
+    # lookups and better locality when the transforms group and join on them
+    con_duck.execute(
+        f"CREATE OR REPLACE TABLE enrollments AS SELECT {select_list} FROM {source} "
+        "ORDER BY EMPLID, STRM",
+        [enrollments_path],
+    )
 
 def load_departments_to_duckdb(con_duck, departments_path):
-    with open(departments_path, "r") as f:
-        data = json.load(f)
-    dept_df = pd.DataFrame(data)
-    dept_df.columns = [c.upper() for c in dept_df.columns]
-    for c in dept_df.select_dtypes(include=["object", "string"]).columns:
-        dept_df[c] = dept_df[c].str.strip()
-    con_duck.register("tmp_dept", dept_df)
-    con_duck.execute("CREATE OR REPLACE TABLE departments AS SELECT * FROM tmp_dept")
-    con_duck.unregister("tmp_dept")
-    
-    # print(f"  ✓ Loaded departments: {len(dept_df)} departments")
+    # DuckDB parses the JSON array straight into columns; no json.load/DataFrame copy
+    source = "read_json(?, format='array')"
+    select_list = _clean_select_list(con_duck, source, params=[departments_path])
+    con_duck.execute(
+        f"CREATE OR REPLACE TABLE departments AS SELECT {select_list} FROM {source} "
+        "ORDER BY DEPT_CODE",
+        [departments_path],
+    )
 
-# main transform SQL 
-final_sql = r"""
--- total credits per student-term
-CREATE OR REPLACE VIEW total_credits AS
-SELECT EMPLID AS student_id, STRM AS term, SUM(CAST(CREDIT_HOURS AS INTEGER)) AS total_credits
-FROM enrollments
-GROUP BY EMPLID, STRM;
+LOADERS = [
+    ("sqlite tables", load_sqlite_tables_to_duckdb, SQLITE_PATH),
+    ("enrollments", load_enrollments_to_duckdb, ENROLLMENTS_PATH),
+    ("departments", load_departments_to_duckdb, DEPARTMENTS_PATH),
+]
+
+def load_sources_in_parallel(con_duck, loaders=LOADERS):
+    # the sources are independent files feeding disjoint tables, so each loader runs
+    # on its own cursor and transaction. Nothing commits until every load succeeded;
+    # the commits themselves are sequential, and if one fails partway the snapshot
+    # (recorded only after this returns) no longer matches, so the next run reloads
+    cursors = [con_duck.cursor() for _ in loaders]
+    try:
+        for cur in cursors:
+            cur.execute("BEGIN TRANSACTION")
+        with ThreadPoolExecutor(max_workers=len(loaders)) as pool:
+            futures = [pool.submit(loader, cur, path)
+                       for cur, (_, loader, path) in zip(cursors, loaders)]
+            for (name, _, _), future in zip(loaders, futures):
+                future.result()
+                print(f"  ✓ Loaded {name}")
+        for cur in cursors:
+            cur.execute("COMMIT")
+    finally:
+        # closing a cursor with an open transaction rolls it back
+        for cur in cursors:
+            cur.close()
+
+# input snapshot bookkeeping: ku.duckdb remembers which inputs it was built from,
+# and with which version of the load logic
+# bump whenever a loader or its load SQL changes, so existing databases reload
+LOADER_VERSION = 2
+SOURCE_TABLES = ("student", "acad_prog", "enrollments", "departments")
 
--- credits per student-term-department
-CREATE OR REPLACE VIEW credits_by_dept AS
+def _input_signature(paths):
+    return sorted((path, os.stat(path).st_mtime_ns, os.path.getsize(path), LOADER_VERSION)
+                  for path in paths)
+
+def _inputs_unchanged(con_duck, signature):
+    # a snapshot from an older layout, or one missing a source table, is a cache miss
+    has_meta = con_duck.execute(
+        "SELECT COUNT(*) FROM duckdb_columns() "
+        "WHERE table_name = '_pipeline_meta' AND column_name = 'loader_version'"
+    ).fetchone()[0]
+    if not has_meta:
+        return False
+    present = {r[0] for r in con_duck.execute("SELECT table_name FROM duckdb_tables()").fetchall()}
+    if not present.issuperset(SOURCE_TABLES):
+        return False
+    stored = con_duck.execute(
+        "SELECT input_path, mtime_ns, size, loader_version FROM _pipeline_meta ORDER BY input_path"
+    ).fetchall()
+    return stored == signature
+
+def _record_inputs(con_duck, signature):
+    con_duck.execute(
+        "CREATE OR REPLACE TABLE _pipeline_meta "
+        "(input_path VARCHAR, mtime_ns BIGINT, size BIGINT, loader_version INTEGER)"
+    )
+    con_duck.executemany("INSERT INTO _pipeline_meta VALUES (?, ?, ?, ?)", signature)
+
+# main transform SQL 
+transform_sql = r"""
+-- credits per student-term-department (the only scan of enrollments)
+CREATE OR REPLACE TABLE credits_by_dept AS
 SELECT EMPLID AS student_id, STRM AS term, DEPARTMENT AS dept_code,
-       SUM(CAST(CREDIT_HOURS AS INTEGER)) AS dept_credits
+       SUM(CREDIT_HOURS) AS dept_credits
 FROM enrollments
 GROUP BY EMPLID, STRM, DEPARTMENT;
 
--- rank departments per student-term (tie-break: dept name alphabetical)
-CREATE OR REPLACE VIEW ranked_depts AS
-SELECT
-  c.student_id,
-  c.term,
-  c.dept_code,
-  COALESCE(d.DEPT_NAME, c.dept_code) AS dept_name,
-  d.CONTACT_PERSON AS dept_contact,
-  ROW_NUMBER() OVER (
-    PARTITION BY c.student_id, c.term
-    ORDER BY c.dept_credits DESC, COALESCE(d.DEPT_NAME, c.dept_code) ASC
-  ) AS rn
-FROM credits_by_dept c
+-- total credits per student-term, rolled up from the much smaller credits_by_dept
+CREATE OR REPLACE TABLE total_credits AS
+SELECT student_id, term, SUM(dept_credits) AS total_credits
+FROM credits_by_dept
+GROUP BY student_id, term;
+
+-- one row per department code seen in enrollments: display name (falls back to
+-- the code when departments has no entry) and contact, resolved once per code
+CREATE OR REPLACE TABLE dept_map AS
+SELECT c.dept_code, COALESCE(d.DEPT_NAME, c.dept_code) AS dept_name, d.CONTACT_PERSON AS dept_contact
+FROM (SELECT DISTINCT dept_code FROM credits_by_dept) c
 LEFT JOIN departments d ON c.dept_code = d.DEPT_CODE;
 
--- final select returns one row per student per term with focused dept (rn=1)
+-- top-ranked department per student-term (tie-break: dept name alphabetical);
+-- arg_min over (-credits, name) picks it in one hash aggregate, no partition sort
+CREATE OR REPLACE TABLE ranked_depts AS
+SELECT student_id, term, top.dept_code, top.dept_name, top.dept_contact
+FROM (
+  SELECT
+    c.student_id,
+    c.term,
+    arg_min(
+      {'dept_code': c.dept_code, 'dept_name': m.dept_name, 'dept_contact': m.dept_contact},
+      (-c.dept_credits, m.dept_name)
+    ) AS top
+  FROM credits_by_dept c
+  LEFT JOIN dept_map m ON c.dept_code = m.dept_code
+  GROUP BY c.student_id, c.term
+);
+"""
+
+# these transforms used to be views, and a ku.duckdb built back then still holds
+# them; CREATE OR REPLACE TABLE won't replace a view (and DROP VIEW IF EXISTS
+# errors once the name is a table), so drop only the ones that are still views
+LEGACY_VIEWS = ("ranked_depts", "total_credits", "credits_by_dept")
+
+def run_transforms(con_duck):
+    views = {r[0] for r in con_duck.execute(
+        "SELECT view_name FROM duckdb_views() WHERE NOT internal").fetchall()}
+    for name in LEGACY_VIEWS:
+        if name in views:
+            con_duck.execute(f"DROP VIEW {name}")
+    con_duck.execute(transform_sql)
+
+# report select returns one row per student per term with its focused dept;
+# COPY writes NULL as an empty field but quotes empty strings (""), so blank text
+# is turned into NULL to keep the plain empty fields the report has always had
+report_sql = r"""
 SELECT
   t.student_id,
-  s.LAST_NAME AS last_name,
+  NULLIF(s.LAST_NAME, '') AS last_name,
   t.term,
-  t.total_credits,
-  rd.dept_name AS focused_department_name,
-  rd.dept_contact AS focused_department_contact
+  t.total_credits::BIGINT AS total_credits,
+  NULLIF(rd.dept_name, '') AS focused_department_name,
+  NULLIF(rd.dept_contact, '') AS focused_department_contact
 FROM total_credits t
-LEFT JOIN ranked_depts rd ON t.student_id = rd.student_id AND t.term = rd.term AND rd.rn = 1
+LEFT JOIN ranked_depts rd ON t.student_id = rd.student_id AND t.term = rd.term
 LEFT JOIN student s ON t.student_id = s.EMPLID
-ORDER BY t.student_id, t.term;
+ORDER BY t.student_id, t.term
 """
 
+def write_report(con_duck, path):
+    # DuckDB writes the CSV itself (no pandas round-trip); COPY returns the row count
+    return con_duck.execute(
+        f"COPY ({report_sql}) TO ? (HEADER, DELIMITER ',')", [path]
+    ).fetchone()[0]
+
 def run():
     print("Starting load_and_transform...")
     
@@ -134,37 +342,30 @@ def run():
     # connect to/create duckdb file
     con = duckdb.connect(database=OUT_DUCKDB, read_only=False)
     try:
-        print("Loading sqlite tables...")
-        load_sqlite_tables_to_duckdb(con, SQLITE_PATH)
+        configure(con)
 
-        print("Loading enrollments...")
-        load_enrollments_to_duckdb(con, ENROLLMENTS_PATH)
+        # reuse the tables already in ku.duckdb when no input file has changed
+        signature = _input_signature(required_files.values())
+        reload = not _inputs_unchanged(con, signature)
+        if reload:
+            print("Loading sqlite tables, enrollments and departments...")
+            load_sources_in_parallel(con)
+        else:
+            print("Inputs unchanged since last run, using cached tables in ku.duckdb")
 
-        print("Loading departments...")
-        load_departments_to_duckdb(con, DEPARTMENTS_PATH)
+        # record the snapshot and transform in a single transaction: one commit
+        # instead of one per CREATE TABLE, and a failed run rolls back (on close).
+        # It starts after the loads commit so its snapshot sees the new tables.
+        con.execute("BEGIN TRANSACTION")
+        if reload:
+            _record_inputs(con, signature)
 
         print("Running SQL transforms...")
-        # Execute the SQL and capture result
-        df_out = con.execute(final_sql).df()
-        print(f"  ✓ Generated report: {len(df_out)} rows")
-
-        # Ensure exact columns in safe way (avoid KeyError)
-        desired_cols = ["student_id", "last_name", "term", "total_credits",
-                        "focused_department_name", "focused_department_contact"]
-
-        # reindex will add missing columns as NaN instead of crashing
-        df_out = df_out.reindex(columns=desired_cols)
-
-        # Convert total_credits to integer
-        if "total_credits" in df_out.columns:
-            df_out["total_credits"] = df_out["total_credits"].fillna(0).astype(int)
-
-        # Replace any NaN in contact with empty string for nicer CSV
-        if "focused_department_contact" in df_out.columns:
-            df_out["focused_department_contact"] = df_out["focused_department_contact"].fillna("")
+        run_transforms(con)
+        con.execute("COMMIT")
 
-        # Write CSV without quotes to match expected format
-        df_out.to_csv(OUT_CSV, index=False)  # quoting=1 would add quotes around all values
+        row_count = write_report(con, OUT_CSV)
+        print(f"  ✓ Generated report: {row_count} rows")
         print("Done — output written to:", OUT_CSV)
 
     except Exception as e:
@@ -2,6 +2,9 @@
 Simple unit tests for the KU Student Data Pipeline
 """
 import os
+import sys
+import sqlite3
+import tempfile
 import pandas as pd
 import duckdb
 
@@ -10,6 +13,9 @@ ROOT = os.path.dirname(os.path.abspath(__file__))
 OUT_CSV = os.path.join(ROOT, "output.csv")
 OUT_DUCKDB = os.path.join(ROOT, "ku.duckdb")
 
+sys.path.insert(0, os.path.join(ROOT, "src"))
+import load_and_transform
+
 def test_output_csv_exists():
     """Test that output.csv was created"""
     assert os.path.exists(OUT_CSV), "output.csv not found"
@@ -84,6 +90,229 @@ def test_sample_data_matches():
     else:
         print("⚠ Warning: Sample student not found in output")
 
+def test_sqlite_type_mismatch_loads_as_text():
+    """Test that a sqlite table with values not matching their declared type still loads"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "student_info.sqlite3")
+        src = sqlite3.connect(path)
+        src.execute("CREATE TABLE student (emplid INTEGER, last_name TEXT)")
+        src.executemany("INSERT INTO student VALUES (?, ?)", [(1, "Diaz"), ("x2", "Kim")])
+        src.execute("CREATE TABLE acad_prog (emplid INTEGER, acad_prog TEXT)")
+        src.execute("INSERT INTO acad_prog VALUES (1, 'BS')")
+        src.commit()
+        src.close()
+        con = duckdb.connect(":memory:")
+        try:
+            con.execute("BEGIN TRANSACTION")
+            load_and_transform.load_sqlite_tables_to_duckdb(con, path)
+            con.execute("COMMIT")
+            students = con.execute("SELECT EMPLID, LAST_NAME FROM student ORDER BY EMPLID").fetchall()
+            progs = con.execute("SELECT EMPLID, ACAD_PROG FROM acad_prog").fetchall()
+        finally:
+            con.close()
+    assert students == [("1", "Diaz"), ("x2", "Kim")], f"Unexpected students: {students}"
+    assert progs == [(1, "BS")], f"Unexpected programs: {progs}"
+    print("✓ Test passed: mismatched sqlite values load as text")
+
+def test_credit_hours_coercion():
+    """Test that malformed credit hours load as 0 and fractional ones are truncated"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "enrollments.dat")
+        with open(path, "w") as f:
+            f.write("EMPLID|STRM|DEPARTMENT|CREDIT_HOURS\n")
+            f.write("1|2244|PHYS|abc\n")
+            f.write("2|2244|PHYS|NaN\n")
+            f.write("3|2244|PHYS|nan\n")
+            f.write("4|2244|PHYS| 3.7 \n")
+            f.write("5|2244|PHYS|\n")
+            f.write("6|2244|PHYS|1e20\n")
+            f.write("7|2244|PHYS|4000000000\n")
+        con = duckdb.connect(":memory:")
+        try:
+            load_and_transform.load_enrollments_to_duckdb(con, path)
+            credits = dict(con.execute("SELECT EMPLID, CREDIT_HOURS FROM enrollments").fetchall())
+        finally:
+            con.close()
+    assert credits == {"1": 0, "2": 0, "3": 0, "4": 3, "5": 0, "6": 0, "7": 4000000000}, \
+        f"Unexpected credit hours: {credits}"
+    print("✓ Test passed: credit hours are coerced like the original loader")
+
+def test_enrollments_short_rows_and_na_tokens():
+    """Test that short rows are padded and pandas' NA tokens load as NULL"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "enrollments.dat")
+        with open(path, "w") as f:
+            f.write("EMPLID|STRM|DEPARTMENT|CREDIT_HOURS\n")
+            f.write("1|2244|PHYS|3\n")
+            f.write("2|2244|PHYS\n")
+            f.write("3|2244|NA|2\n")
+            f.write("4|2244|null|n/a\n")
+        con = duckdb.connect(":memory:")
+        try:
+            load_and_transform.load_enrollments_to_duckdb(con, path)
+            rows = con.execute("SELECT EMPLID, DEPARTMENT, CREDIT_HOURS FROM enrollments").fetchall()
+        finally:
+            con.close()
+    assert rows == [("1", "PHYS", 3), ("2", "PHYS", 0), ("3", None, 2), ("4", None, 0)], \
+        f"Unexpected enrollments: {rows}"
+    print("✓ Test passed: short rows and NA tokens load like the original loader")
+
+def test_report_blank_fields_unquoted():
+    """Test that blank names and contacts are written as empty, unquoted fields"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "report.csv")
+        con = duckdb.connect(":memory:")
+        try:
+            con.execute("""
+                CREATE TABLE total_credits AS SELECT * FROM (VALUES
+                    ('1', '2244', 3), ('2', '2244', 4)) t(student_id, term, total_credits);
+                CREATE TABLE ranked_depts AS SELECT * FROM (VALUES
+                    ('1', '2244', 'EMP', 'Empty', ''), ('2', '2244', 'X', '', 'x'))
+                    t(student_id, term, dept_code, dept_name, dept_contact);
+                CREATE TABLE student AS SELECT * FROM (VALUES
+                    ('1', 'Diaz'), ('2', '')) t(EMPLID, LAST_NAME);
+            """)
+            row_count = load_and_transform.write_report(con, path)
+        finally:
+            con.close()
+        with open(path) as f:
+            lines = f.read().splitlines()
+    assert row_count == 2, f"Unexpected row count: {row_count}"
+    assert lines[1:] == ["1,Diaz,2244,3,Empty,", "2,,2244,4,,x"], f"Unexpected report rows: {lines[1:]}"
+    print("✓ Test passed: blank report fields are written unquoted")
+
+def test_transforms_replace_legacy_views():
+    """Test that a ku.duckdb holding the old transform views is rebuilt as tables"""
+    con = duckdb.connect(":memory:")
+    try:
+        con.execute("""
+            CREATE TABLE enrollments AS SELECT * FROM (VALUES
+                ('1', '2244', 'PHYS', 3), ('1', '2244', 'MATH', 4)) t(EMPLID, STRM, DEPARTMENT, CREDIT_HOURS);
+            CREATE TABLE departments AS SELECT * FROM (VALUES
+                ('MATH', 'Mathematics', 'Dr. Ada')) t(DEPT_CODE, DEPT_NAME, CONTACT_PERSON);
+            CREATE VIEW total_credits AS
+                SELECT EMPLID AS student_id, STRM AS term, SUM(CREDIT_HOURS) AS total_credits
+                FROM enrollments GROUP BY EMPLID, STRM;
+            CREATE VIEW credits_by_dept AS
+                SELECT EMPLID AS student_id, STRM AS term, DEPARTMENT AS dept_code,
+                       SUM(CREDIT_HOURS) AS dept_credits
+                FROM enrollments GROUP BY EMPLID, STRM, DEPARTMENT;
+            CREATE VIEW ranked_depts AS SELECT * FROM credits_by_dept;
+        """)
+        # twice: the second run finds tables, not views
+        for _ in range(2):
+            con.execute("BEGIN TRANSACTION")
+            load_and_transform.run_transforms(con)
+            con.execute("COMMIT")
+        views = con.execute("SELECT view_name FROM duckdb_views() WHERE NOT internal").fetchall()
+        top = con.execute("SELECT dept_code, dept_name FROM ranked_depts").fetchall()
+    finally:
+        con.close()
+    assert views == [], f"Legacy views left behind: {views}"
+    assert top == [("MATH", "Mathematics")], f"Unexpected focused department: {top}"
+    print("✓ Test passed: legacy transform views are replaced by tables")
+
+def test_failed_load_keeps_previous_tables():
+    """Test that a loader failing leaves every previously loaded table intact"""
+    with tempfile.TemporaryDirectory() as tmp:
+        sqlite_path = os.path.join(tmp, "student_info.sqlite3")
+        src = sqlite3.connect(sqlite_path)
+        src.execute("CREATE TABLE student (emplid INTEGER, last_name TEXT)")
+        src.execute("INSERT INTO student VALUES (2, 'New')")
+        src.commit()
+        src.close()
+        enrollments_path = os.path.join(tmp, "enrollments.dat")
+        with open(enrollments_path, "w") as f:
+            f.write("EMPLID|STRM|DEPARTMENT|CREDIT_HOURS\n2|2244|NEW|9\n")
+        departments_path = os.path.join(tmp, "departments.json")
+        with open(departments_path, "w") as f:
+            f.write('[{"dept_code": "NEW", ')
+        loaders = [
+            ("sqlite tables", load_and_transform.load_sqlite_tables_to_duckdb, sqlite_path),
+            ("enrollments", load_and_transform.load_enrollments_to_duckdb, enrollments_path),
+            ("departments", load_and_transform.load_departments_to_duckdb, departments_path),
+        ]
+        con = duckdb.connect(os.path.join(tmp, "ku.duckdb"))
+        try:
+            con.execute("""
+                CREATE TABLE student AS SELECT 1 AS EMPLID, 'Old' AS LAST_NAME;
+                CREATE TABLE enrollments AS SELECT '1' AS EMPLID, 'OLD' AS DEPARTMENT;
+                CREATE TABLE departments AS SELECT 'OLD' AS DEPT_CODE;
+            """)
+            try:
+                load_and_transform.load_sources_in_parallel(con, loaders)
+                failed = False
+            except duckdb.Error:
+                failed = True
+            tables = [con.execute(f"SELECT * FROM {t}").fetchall()
+                      for t in ("student", "enrollments", "departments")]
+        finally:
+            con.close()
+    assert failed, "Malformed departments.json should fail the load"
+    assert tables == [[(1, "Old")], [("1", "OLD")], [("OLD",)]], f"Previous tables changed: {tables}"
+    print("✓ Test passed: a failed load keeps the previous tables")
+
+def _cached_db(tmp):
+    """Create input files and a ku.duckdb in tmp that records them as loaded"""
+    paths = []
+    for name in ("student_info.sqlite3", "enrollments.dat", "departments.json"):
+        paths.append(os.path.join(tmp, name))
+        with open(paths[-1], "w") as f:
+            f.write("x")
+    con = duckdb.connect(os.path.join(tmp, "ku.duckdb"))
+    for table in load_and_transform.SOURCE_TABLES:
+        con.execute(f"CREATE TABLE {table} (id INTEGER)")
+    load_and_transform._record_inputs(con, load_and_transform._input_signature(paths))
+    return con, paths
+
+def _cache_hit(con, paths):
+    return load_and_transform._inputs_unchanged(con, load_and_transform._input_signature(paths))
+
+def test_input_cache_invalidation():
+    """Test that cached tables are reused only while inputs and loader version match"""
+    with tempfile.TemporaryDirectory() as tmp:
+        con, paths = _cached_db(tmp)
+        try:
+            assert _cache_hit(con, paths), "Unchanged inputs should hit the cache"
+
+            stat = os.stat(paths[0])
+            os.utime(paths[0], ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+            assert not _cache_hit(con, paths), "A newer mtime should miss the cache"
+            load_and_transform._record_inputs(con, load_and_transform._input_signature(paths))
+
+            stat = os.stat(paths[1])
+            with open(paths[1], "a") as f:
+                f.write("y")
+            os.utime(paths[1], ns=(stat.st_atime_ns, stat.st_mtime_ns))
+            assert not _cache_hit(con, paths), "A size change should miss the cache"
+            load_and_transform._record_inputs(con, load_and_transform._input_signature(paths))
+            assert _cache_hit(con, paths), "Re-recorded inputs should hit the cache"
+
+            con.execute("UPDATE _pipeline_meta SET loader_version = loader_version - 1")
+            assert not _cache_hit(con, paths), "An older loader version should miss the cache"
+        finally:
+            con.close()
+    print("✓ Test passed: input changes and loader version invalidate the cache")
+
+def test_input_cache_miss_on_missing_tables():
+    """Test that a dropped source table or a database from the view-based layout reloads"""
+    with tempfile.TemporaryDirectory() as tmp:
+        con, paths = _cached_db(tmp)
+        try:
+            con.execute("DROP TABLE departments")
+            assert not _cache_hit(con, paths), "A dropped source table should miss the cache"
+
+            # the original pipeline kept no snapshot and built the transforms as views
+            con.execute("CREATE TABLE departments (id INTEGER)")
+            con.execute("DROP TABLE _pipeline_meta")
+            con.execute("CREATE VIEW credits_by_dept AS SELECT * FROM enrollments")
+            con.execute("CREATE VIEW total_credits AS SELECT * FROM enrollments")
+            con.execute("CREATE VIEW ranked_depts AS SELECT * FROM credits_by_dept")
+            assert not _cache_hit(con, paths), "A database without a snapshot should miss the cache"
+        finally:
+            con.close()
+    print("✓ Test passed: missing tables and old databases invalidate the cache")
+
 def run_all_tests():
     """Run all tests"""
     print("\n" + "="*60)
@@ -99,7 +328,15 @@ def run_all_tests():
         test_no_duplicate_student_term,
         test_duckdb_exists,
         test_duckdb_tables,
-        test_sample_data_matches
+        test_sample_data_matches,
+        test_sqlite_type_mismatch_loads_as_text,
+        test_credit_hours_coercion,
+        test_enrollments_short_rows_and_na_tokens,
+        test_report_blank_fields_unquoted,
+        test_failed_load_keeps_previous_tables,
+        test_transforms_replace_legacy_views,
+        test_input_cache_invalidation,
+        test_input_cache_miss_on_missing_tables
     ]
     
     passed = 0